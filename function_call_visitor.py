@@ -0,0 +1,231 @@
+"""AST traversal for search_for_statusdb_interactions
+
+Kept in its own module with type annotations so that it can optionally be
+compiled with mypyc (see README). The compiled extension is picked up
+automatically by the import in search_for_statusdb_interactions.py.
+"""
+
+import ast
+import sys
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Handlers return the marker to push for leaving the scope they open, if any
+Handler = Callable[[Any], Optional[object]]
+
+# Markers pushed onto the stack below a node's children, so that the scope is
+# left once all of them have been visited
+LEAVE_CLASS = object()
+LEAVE_FUNCTION = object()
+
+# Node types that can never have a Call below them, so they are not pushed
+# onto the stack at all. Load/Store/Del hang off every Name, Attribute etc.
+# as the ctx field and make up a large share of all nodes. ast.arg is left
+# out since its annotation may contain a call.
+LEAF_NODE_TYPES = frozenset(
+    {ast.Constant, ast.Name, ast.alias, ast.Load, ast.Store, ast.Del, ast.Pass}
+)
+
+
+class Context:
+    # One Context is created per function call found, so avoid a __dict__ per instance
+    __slots__ = (
+        "file_name",
+        "line_number",
+        "object",
+        "argument",
+        "keyword_arguments",
+        "function_scope",
+        "class_scope",
+        "_key",
+        "_has_variables",
+    )
+
+    def __init__(
+        self,
+        file_name: str,
+        line_number: int,
+        object: str,
+        argument: Any,
+        keyword_arguments: List[Optional[str]],
+        function_scope: Optional[str],
+        class_scope: Optional[str],
+    ) -> None:
+        self.file_name = file_name
+        self.line_number = line_number
+        self.object = object
+        self.argument = argument
+        self.keyword_arguments = keyword_arguments
+        self.function_scope = function_scope
+        self.class_scope = class_scope
+        # Both are looked up for every context, so compute them once
+        self._key: Tuple[str, str, str] = (
+            file_name,
+            class_scope if class_scope else "",
+            function_scope if function_scope else "",
+        )
+        self._has_variables: bool = "<variable:" in argument or "<variable:" in object
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Contexts are pickled when sent back from worker processes. Rebuilding
+        # them through __init__ also works when the class is compiled with mypyc.
+        return (
+            Context,
+            (
+                self.file_name,
+                self.line_number,
+                self.object,
+                self.argument,
+                self.keyword_arguments,
+                self.function_scope,
+                self.class_scope,
+            ),
+        )
+
+    def print(self) -> None:
+        print(
+            f"Function {self.object}({self.argument}) called with keyword argument {self.keyword_arguments} within {self.class_scope}:{self.function_scope} in {self.file_name}:{self.line_number}"
+        )
+
+    def to_key(self) -> Tuple[str, str, str]:
+        return self._key
+
+    def has_variables(self) -> bool:
+        return self._has_variables
+
+    def curation_suggestion(self) -> str:
+        suggestion = f"{','.join(list(self.to_key()))},{self.object},"
+        suggestion += (
+            "---possible db value---" if "<variable:" in self.object else self.object
+        )
+        suggestion += f",{self.argument},"
+        suggestion += (
+            "---possible view value---"
+            if "<variable:" in self.argument
+            else self.argument
+        )
+        suggestion += "\n"
+        return suggestion
+
+
+class FunctionCallVisitor:
+    """Collects calls to the target functions together with the class and function they are made in
+
+    The tree is walked with an explicit stack rather than the recursive
+    dispatch of ast.NodeVisitor. Leaving a class or function is signalled by
+    a marker pushed below the node's children, so the scope bookkeeping is
+    the same as with the recursive visitor.
+    """
+
+    def __init__(self, target_functions: Iterable[str], file_name: str) -> None:
+        # A single name would otherwise be split into its characters
+        if isinstance(target_functions, str):
+            target_functions = (target_functions,)
+        self.target_functions = frozenset(target_functions)
+        self.function_calls: List[Context] = []
+        self.file_name = file_name
+        self.current_function: Optional[str] = None
+        self.current_class: Optional[str] = None
+        self.prev_function: Optional[str] = None
+        # Handlers by exact node type, built once instead of looking up a
+        # visit_<class name> method for every node. Each handler returns the
+        # marker for leaving the node's scope, if it opens one.
+        self._dispatch: Dict[type, Handler] = {
+            ast.ClassDef: self.visit_ClassDef,
+            ast.FunctionDef: self.visit_FunctionDef,
+            ast.Call: self.visit_Call,
+        }
+
+    def visit(self, tree: ast.AST) -> None:
+        dispatch = self._dispatch
+        leaf_node_types = LEAF_NODE_TYPES
+        stack: List[Any] = [tree]
+        while stack:
+            node = stack.pop()
+            if node is LEAVE_CLASS:
+                self.current_class = None
+                continue
+            if node is LEAVE_FUNCTION:
+                self.current_function = self.prev_function
+                continue
+
+            handler = dispatch.get(type(node))
+            if handler is not None:
+                leave_marker = handler(node)
+                if leave_marker is not None:
+                    stack.append(leave_marker)
+
+            # Push children in reverse so they are visited in source order.
+            # This inlines ast.iter_child_nodes, which is a lot slower as a generator.
+            for field in reversed(node._fields):
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    for item in reversed(value):
+                        if (
+                            isinstance(item, ast.AST)
+                            and type(item) not in leaf_node_types
+                        ):
+                            stack.append(item)
+                elif isinstance(value, ast.AST) and type(value) not in leaf_node_types:
+                    stack.append(value)
+
+    def visit_ClassDef(self, node: Any) -> Optional[object]:
+        # Scope names end up in every Context created below them
+        self.current_class = sys.intern(node.name)
+        return LEAVE_CLASS
+
+    def visit_FunctionDef(self, node: Any) -> Optional[object]:
+        # Saving the previous function will allow tested functions
+        # (functions defined within other function bodies) to be tracked up to 1 level
+        self.prev_function = self.current_function
+        self.current_function = sys.intern(node.name)
+        return LEAVE_FUNCTION
+
+    def visit_Call(self, node: Any) -> Optional[object]:
+        if (
+            isinstance(node.func, ast.Attribute)
+            and node.func.attr in self.target_functions
+        ):
+            argument: Any = ""
+            for arg in node.args:
+                if isinstance(arg, ast.Name):
+                    argument = f"<variable:{arg.id}>"
+                elif isinstance(arg, ast.JoinedStr):
+                    argument = self.handle_joined_str(arg)
+                else:
+                    argument = arg.value
+
+            kw_arguments = [keyword.arg for keyword in node.keywords]
+
+            # Try to figure out which database the view is called on
+            called_on: Any = node.func.value
+            if isinstance(called_on, ast.Name):
+                # The function is called on a variable, this needs to be dealt with manually (manual curation file)
+                object = f"<variable:{called_on.id}>"
+            elif called_on.attr == "db":
+                # Common name of object that should be considered a variable as well
+                object = "<variable:db>"
+            else:
+                object = called_on.attr
+
+            context = Context(
+                file_name=self.file_name,
+                line_number=node.lineno,
+                object=object,
+                argument=argument,
+                keyword_arguments=kw_arguments,
+                function_scope=self.current_function,
+                class_scope=self.current_class,
+            )
+            self.function_calls.append(context)
+        return None
+
+    def handle_joined_str(self, arg: Any) -> str:
+        values: List[Any] = arg.values
+        return "".join(
+            [
+                f"<variable:{value.value.id}>"  # type: ignore[attr-defined]
+                if isinstance(value, ast.FormattedValue)
+                else value.s
+                for value in values
+            ]
+        )
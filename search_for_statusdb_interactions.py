@@ -1,47 +1,94 @@
 import ast
 import argparse
+import concurrent.futures
 import csv
+import functools
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import operator
 import os
+import pickle
+import sys
+import tempfile
 
-import pandas as pd
+import function_call_visitor
+from function_call_visitor import Context, FunctionCallVisitor
 
 logger = logging.getLogger(__name__)
 
-
-class Context:
-    def __init__(
-        self,
-        file_name,
-        line_number,
-        object,
-        argument,
-        keyword_arguments,
-        function_scope,
-        class_scope,
-    ):
-        self.file_name = file_name
-        self.line_number = line_number
-        self.object = object
-        self.argument = argument
-        self.keyword_arguments = keyword_arguments
-        self.function_scope = function_scope
-        self.class_scope = class_scope
-
-    def print(self):
-        print(
-            f"Function {self.object}({self.argument}) called with keyword argument {self.keyword_arguments} within {self.class_scope}:{self.function_scope} in {self.file_name}:{self.line_number}"
-        )
-
-    def to_key(self):
-        return (
-            self.file_name,
-            self.class_scope if self.class_scope else "",
-            self.function_scope if self.function_scope else "",
-        )
-
-    def has_variables(self):
-        return "<variable:" in self.argument or "<variable:" in self.object
+RESULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "statusdb_tracer",
+)
+# Bump when the cached call tuples change shape. Changes to the visitor
+# itself are picked up by its fingerprint in the cache key.
+RESULT_CACHE_VERSION = 1
+
+# Number of threads listing directories in parallel
+SCAN_THREADS = 8
+
+# Cell values in the manual curation file that are treated as missing, the
+# same strings pandas' read_csv treats as NA by default. "None" is what the
+# curation file uses when there is no class.
+MISSING_VALUES = {
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+}
+KEY_COLUMNS = ("Path", "Class", "Function")
+VALUE_COLUMNS = (
+    "Database_variable_name",
+    "Database_variable_value",
+    "View_variable_name",
+    "View_variable_value",
+)
+
+
+def strip_comments(lines):
+    """Cut each line at the first "#" outside a quoted field, like pandas' comment option
+
+    As with csv, a double quote only opens a quoted field at the start of a
+    field and "" inside a quoted field is an escaped quote. A quoted field
+    may continue on the next line.
+    """
+    in_quotes = False
+    for line in lines:
+        field_start = not in_quotes
+        i = 0
+        while i < len(line):
+            char = line[i]
+            if in_quotes:
+                if char == '"':
+                    if line[i + 1 : i + 2] == '"':
+                        i += 1
+                    else:
+                        in_quotes = False
+            elif char == '"' and field_start:
+                in_quotes = True
+            elif char == "#":
+                line = line[:i] + "\n"
+                break
+            field_start = not in_quotes and char == ","
+            i += 1
+        yield line
 
 
 class ManualCuration(object):
@@ -50,180 +97,294 @@ class ManualCuration(object):
     def __init__(self, file_name):
         self.file_name = file_name
         self.fields = {}
+        # Curation rows indexed by (key, database variable name, view variable name)
+        self.index = {}
 
     def parse(self):
         logger.debug(f"Parsing manual curation file {self.file_name}")
-        df = pd.read_table(self.file_name, sep=",", header=0, comment="#")
-        df = df.fillna("")
-
-        for _, row in df.iterrows():
-            key_t = tuple(row[["Path", "Class", "Function"]].values)
-            val_t = tuple(
-                row[
-                    [
-                        "Database_variable_name",
-                        "Database_variable_value",
-                        "View_variable_name",
-                        "View_variable_value",
-                    ]
-                ].values
+        with open(self.file_name, newline="") as f:
+            # Lines that are empty once comments are removed come out as empty rows
+            reader = csv.reader(strip_comments(f))
+            header = next((row for row in reader if row), [])
+            # Resolve the column positions once rather than building a dict per row
+            get_key = operator.itemgetter(
+                *(header.index(column) for column in KEY_COLUMNS)
             )
-            if key_t not in self.fields:
-                self.fields[key_t] = []
-            self.fields[key_t].append(val_t)
+            get_value = operator.itemgetter(
+                *(header.index(column) for column in VALUE_COLUMNS)
+            )
+            for row in reader:
+                if not row:
+                    continue
+                row = ["" if value in MISSING_VALUES else value for value in row]
+                row.extend([""] * (len(header) - len(row)))
+                key_t = get_key(row)
+                val_t = get_value(row)
+                if key_t not in self.fields:
+                    self.fields[key_t] = []
+                self.fields[key_t].append(val_t)
+
+                index_t = (key_t, val_t[0], val_t[2])
+                if index_t not in self.index:
+                    self.index[index_t] = []
+                self.index[index_t].append(val_t)
 
     def compare_against_manual_curation(self, context):
         new_contexts = []
-        if context.to_key() in self.fields:
-            for val_t in self.fields[context.to_key()]:
-                if context.object == val_t[0] and context.argument == val_t[2]:
-                    logger.debug(
-                        f"Creating new context from manual curation for {val_t}"
-                    )
-                    new_contexts.append(
-                        Context(
-                            context.file_name,
-                            context.line_number,
-                            val_t[1],
-                            val_t[3],
-                            context.keyword_arguments,
-                            context.function_scope,
-                            context.class_scope,
-                        )
-                    )
-        return new_contexts
-
-
-class FunctionCallVisitor(ast.NodeVisitor):
-    def __init__(self, target_function, file_name):
-        self.target_function = target_function
-        self.function_calls = []
-        self.file_name = file_name
-        self.current_function = None
-        self.current_class = None
-        self.prev_function = None
-
-    def visit_ClassDef(self, node):
-        self.current_class = node.name
-        self.generic_visit(node)
-        self.current_class = None
-
-    def visit_FunctionDef(self, node):
-        # Saving the previous function will allow tested functions
-        # (functions defined within other function bodies) to be tracked up to 1 level
-        self.prev_function = self.current_function
-        self.current_function = node.name
-
-        self.generic_visit(node)
-        self.current_function = self.prev_function
-
-    def visit_Call(self, node):
-        if (
-            isinstance(node.func, ast.Attribute)
-            and node.func.attr == self.target_function
-        ):
-            argument = ""
-            for arg in node.args:
-                if isinstance(arg, ast.Name):
-                    argument = f"<variable:{arg.id}>"
-                elif isinstance(arg, ast.JoinedStr):
-                    argument = self.handle_joined_str(arg)
-                else:
-                    argument = arg.value
-
-            kw_arguments = [keyword.arg for keyword in node.keywords]
-
-            # Try to figure out which database the view is called on
-            if isinstance(node.func.value, ast.Name):
-                # The function is called on a variable, this needs to be dealt with manually (manual curation file)
-                object = f"<variable:{node.func.value.id}>"
-            elif node.func.value.attr == "db":
-                # Common name of object that should be considered a variable as well
-                object = "<variable:db>"
-            else:
-                object = node.func.value.attr
-
-            context = Context(
-                file_name=self.file_name,
-                line_number=node.lineno,
-                object=object,
-                argument=argument,
-                keyword_arguments=kw_arguments,
-                function_scope=self.current_function,
-                class_scope=self.current_class,
+        index_t = (context.to_key(), context.object, context.argument)
+        for val_t in self.index.get(index_t, ()):
+            logger.debug(f"Creating new context from manual curation for {val_t}")
+            new_contexts.append(
+                Context(
+                    context.file_name,
+                    context.line_number,
+                    val_t[1],
+                    val_t[3],
+                    context.keyword_arguments,
+                    context.function_scope,
+                    context.class_scope,
+                )
             )
-            self.function_calls.append(context)
-        self.generic_visit(node)
-
-    def handle_joined_str(self, arg):
-        return "".join(
-            [
-                f"<variable:{value.value.id}>"
-                if isinstance(value, ast.FormattedValue)
-                else value.s
-                for value in arg.values
-            ]
-        )
-
+        return new_contexts
 
-def check_file(file_name, target_function, manual_curator, suggestions_file=None):
-    with open(file_name, "r") as f:
-        source_code = f.read()
-    tree = ast.parse(source_code)
 
-    visitor = FunctionCallVisitor(target_function, file_name)
+def visitor_fingerprint():
+    """Hash of the visitor module, or of its mypyc compiled extension when that is used"""
+    with open(function_call_visitor.__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Everything besides the source and target functions that decides the
+# cached result
+RESULT_CACHE_KEY = repr(
+    (RESULT_CACHE_VERSION, tuple(sys.version_info), visitor_fingerprint())
+)
+
+
+def find_function_calls(
+    source, file_name, target_functions, cache_dir=RESULT_CACHE_DIR
+):
+    """Find the calls to the target functions in source code, reusing results cached on disk for unchanged sources
+
+    Only the calls found are cached, not the syntax tree, since loading a
+    pickled tree is slower than parsing the source again. Caching is turned
+    off by passing cache_dir=None. The source is given as bytes, leaving
+    decoding to the parser so that encoding declarations are honoured.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(source)
+        key.update(repr((RESULT_CACHE_KEY, sorted(target_functions))).encode())
+        cache_path = os.path.join(cache_dir, key.hexdigest() + ".pkl")
+        try:
+            with open(cache_path, "rb") as f:
+                calls = pickle.load(f)
+            return [Context(file_name, *call) for call in calls]
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError) as e:
+            logger.debug(f"Ignoring unreadable cache file {cache_path}: {e}")
+
+    tree = compile(source, file_name, "exec", ast.PyCF_ONLY_AST)
+    visitor = FunctionCallVisitor(target_functions, file_name)
     visitor.visit(tree)
-    for context in visitor.function_calls:
+    if cache_path is None:
+        return visitor.function_calls
+
+    # The file name is left out, so that the same source at another path
+    # can reuse the result
+    calls = [
+        (
+            context.line_number,
+            context.object,
+            context.argument,
+            context.keyword_arguments,
+            context.function_scope,
+            context.class_scope,
+        )
+        for context in visitor.function_calls
+    ]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so concurrent runs never see a partial pickle
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            pickle.dump(calls, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, cache_path)
+    except OSError as e:
+        logger.debug(f"Could not write cache file {cache_path}: {e}")
+
+    return visitor.function_calls
+
+
+def read_bytes(file_name):
+    """Read a whole file with raw os.read calls, skipping the buffered io layer"""
+    fd = os.open(file_name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        # Asking for one byte more than the size normally reads the whole file
+        # in one call, the loop only matters if the file grew in the meantime
+        chunks = [os.read(fd, os.fstat(fd).st_size + 1)]
+        while chunks[-1]:
+            chunks.append(os.read(fd, 65536))
+    finally:
+        os.close(fd)
+    return b"".join(chunks)
+
+
+def find_function_calls_in_file(
+    file_name, target_functions, cache_dir=RESULT_CACHE_DIR
+):
+    source = read_bytes(file_name)
+    # A file that never mentions a target function cannot call it, and a
+    # substring search is far cheaper than parsing
+    if not any(target.encode() in source for target in target_functions):
+        return []
+    return find_function_calls(source, file_name, target_functions, cache_dir)
+
+
+def check_file(file_name, target_functions, manual_curator, cache_dir=RESULT_CACHE_DIR):
+    """Find all calls to any of the target functions in a file
+
+    Returns (context, resolved) pairs in source order, where resolved is False
+    for contexts holding variables without matching manual curation. Nothing
+    is printed here, so that files can be checked in worker processes.
+    """
+    if isinstance(target_functions, str):
+        target_functions = (target_functions,)
+    # Every context found shares the file name, so keep a single copy of it
+    file_name = sys.intern(file_name)
+    function_calls = find_function_calls_in_file(file_name, target_functions, cache_dir)
+
+    results = []
+    for context in function_calls:
         extra_contexts = manual_curator.compare_against_manual_curation(context)
         if extra_contexts:
-            for extra_context in extra_contexts:
-                extra_context.print()
-        elif context.has_variables():
-            logger.warning(
-                f"WARNING: Variable found in context {context.file_name}:{context.line_number} without matching manual curation, please add line(s) to manual curation on the following form: \n\t"
-            )
-            suggestion = f"{','.join(list(context.to_key()))},{context.object},"
-            suggestion += (
-                "---possible db value---"
-                if "<variable:" in context.object
-                else context.object
-            )
-            suggestion += f",{context.argument},"
-            suggestion += (
-                "---possible view value---"
-                if "<variable:" in context.argument
-                else context.argument
-            )
-            suggestion += "\n"
-            logger.warning(suggestion)
-            if suggestions_file:
-                with open(suggestions_file, "a") as f:
-                    f.write(suggestion)
+            results.extend((extra_context, True) for extra_context in extra_contexts)
         else:
-            context.print()
+            results.append((context, not context.has_variables()))
+    return results
+
+
+def scan_directory(directory):
+    """List a single directory, returning its subdirectories and python files"""
+    subdirs = []
+    py_files = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                # DirEntry caches the file type from readdir, avoiding a stat call per entry
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(".py") and entry.is_file():
+                    py_files.append(entry.path)
+    except OSError as e:
+        # os.walk silently skips directories it cannot list as well
+        logger.debug(f"Skipping directory {directory}: {e}")
+    return subdirs, py_files
+
+
+def iter_py_files(roots, threads=SCAN_THREADS):
+    """Recursively yield the paths of all python files below the roots, in the same order as os.walk
+
+    Directories are listed ahead of time in a thread pool, as soon as their
+    parent has been listed, so that directory reads overlap with each other
+    and with the files being checked. Results are still consumed depth first.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        stack = [executor.submit(scan_directory, root) for root in reversed(roots)]
+        while stack:
+            subdirs, py_files = stack.pop().result()
+            yield from py_files
+            stack.extend(
+                executor.submit(scan_directory, subdir) for subdir in reversed(subdirs)
+            )
 
 
-def main(target_function, files, dirs, manual_curation_file, suggestions_file):
+def unique_paths(paths):
+    """Yield each path once, comparing paths in normalised form"""
+    seen = set()
+    for path in paths:
+        normalised = os.path.normpath(path)
+        if normalised not in seen:
+            seen.add(normalised)
+            yield path
+
+
+def setup_logging(level):
+    logger.setLevel(level)
+    handler = logging.StreamHandler()
+    handler.setLevel(level)
+    logger.addHandler(handler)
+
+
+def main(
+    target_functions,
+    files,
+    dirs,
+    manual_curation_file,
+    suggestions_file,
+    jobs=None,
+    cache_dir=RESULT_CACHE_DIR,
+):
+    # A single name would otherwise be split into its characters
+    if isinstance(target_functions, str):
+        target_functions = (target_functions,)
+
     manual_curator = ManualCuration(manual_curation_file)
-    manual_curator.parse()
-
-    for file_name in files:
-        check_file(file_name, target_function, manual_curator, suggestions_file)
-
-    # Recurse through directories
-    for directory in dirs:
-        for dirpath, dirs, files in os.walk(directory):
-            for file_name in files:
-                if file_name.endswith(".py"):
-                    file_path = os.path.join(dirpath, file_name)
-                    check_file(
-                        file_path, target_function, manual_curator, suggestions_file
+    # Without a curation file no variables are resolved, they are only reported
+    if manual_curation_file:
+        manual_curator.parse()
+
+    # Files are checked in worker processes, while printing and writing
+    # suggestions is kept in the main process
+    suggestions = []
+    check = functools.partial(
+        check_file,
+        target_functions=frozenset(target_functions),
+        manual_curator=manual_curator,
+        cache_dir=cache_dir,
+    )
+    # Workers are spawned rather than forked, since iter_py_files runs
+    # directory scanning threads while the pool starts its workers and forking
+    # a multi-threaded process can deadlock. Spawned workers do not inherit
+    # the logging setup, so it is repeated in each of them.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=setup_logging,
+        initargs=(logger.level,),
+    ) as executor:
+        # Recurse through directories. A file given with --files may be found
+        # again below one of the --dirs, so only check it once.
+        file_paths = unique_paths(itertools.chain(files, iter_py_files(dirs)))
+        for results in executor.map(check, file_paths, chunksize=32):
+            for context, resolved in results:
+                if resolved:
+                    context.print()
+                else:
+                    logger.warning(
+                        f"WARNING: Variable found in context {context.file_name}:{context.line_number} without matching manual curation, please add line(s) to manual curation on the following form: \n\t"
                     )
+                    suggestion = context.curation_suggestion()
+                    logger.warning(suggestion)
+                    suggestions.append(suggestion)
+
+    if suggestions_file and suggestions:
+        with open(suggestions_file, "a") as f:
+            f.writelines(suggestions)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("target_function", help="The function to search for")
+    parser.add_argument("target_function", nargs="?", help="The function to search for")
+    parser.add_argument(
+        "--target_functions",
+        nargs="+",
+        help="Additional functions to search for, all in the same pass",
+        default=[],
+    )
     parser.add_argument("--files", nargs="+", help="The files to search in", default=[])
     (
         parser.add_argument(
@@ -236,7 +397,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--manual_curation",
         default="manual_curation.csv",
-        help="The file containing manual curation data",
+        help="The file containing manual curation data, pass an empty string to search without it",
     )
     parser.add_argument(
         "--logging_level",
@@ -248,19 +409,39 @@ if __name__ == "__main__":
         default=None,
         help="File to write suggestions for more manual curations to",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes used to check files (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=RESULT_CACHE_DIR,
+        help="Directory where the calls found per file are cached between runs",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Do not read or write the cache",
+    )
 
     args = parser.parse_args()
 
-    # Setup logger
-    logger.setLevel(args.logging_level)
-    handler = logging.StreamHandler()
-    handler.setLevel(args.logging_level)
-    logger.addHandler(handler)
+    target_functions = set(args.target_functions)
+    if args.target_function:
+        target_functions.add(args.target_function)
+    if not target_functions:
+        parser.error("at least one target function is required")
+
+    setup_logging(args.logging_level)
 
     main(
-        args.target_function,
+        target_functions,
         args.files,
         args.dirs,
         args.manual_curation,
         args.suggestions_file,
+        args.jobs,
+        None if args.no_cache else args.cache_dir,
     )